@@ -1,3 +1,3 @@
 #!/bin/bash
 
-rm ./data/*.txt
\ No newline at end of file
+rm -f ./data/*.npy ./data/*.json ./data/*.txt
\ No newline at end of file
@@ -4,96 +4,217 @@ import traceback
 import threading
 import random
 import sys, math, time
-import pathlib
+import os
+import functools
+import json
+import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvas
 from matplotlib.figure import Figure
 from matplotlib import transforms
-from matplotlib.mlab import psd
+import scipy.fft
+import scipy.signal
 from collections import deque
 
 import signal
 # handle potential SIGINT from Ctrl+C
 signal.signal(signal.SIGINT, signal.SIG_DFL)
 
+# simple_scan.py writes .npy files, .txt (csv) is kept for older recordings like ./examples/
+DATA_FILE_SUFFIXES = ('.npy', '.txt')
+
 def get_newest_file(data_dir):
+    # single pass over the directory keeping the two newest names (files are named by timestamp)
+    # the newest file is still being written so return the one before it
+    newest, second = None, None
     try:
-        return sorted(pathlib.Path(data_dir).glob('1*.txt'))[-2]
-    except IndexError:
-        # no files in directory
+        with os.scandir(data_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if not name.startswith('1') or not name.endswith(DATA_FILE_SUFFIXES):
+                    continue
+                if newest is None or name > newest:
+                    second, newest = newest, name
+                elif second is None or name > second:
+                    second = name
+    except FileNotFoundError:
+        # data directory hasn't been created yet
+        return None
+    if second is None:
+        # not enough files in directory
         return None
+    return os.path.join(data_dir, second)
+#
+#   This method pulls the selected channels from file and returns a 2D array
+#   with one column per channel (in the order given by selected_channels).
+#
+def get_channel_data(selected_channels, filename):
+    return np.loadtxt(filename, delimiter=',', usecols=selected_channels, dtype=np.float32, ndmin=2)
+
+@functools.lru_cache(maxsize=2)
+def _load_file(filename, mtime_ns, num_channels):
+    if filename.endswith('.npy'):
+        # memory-mapped, samples are only read from disk when a widget touches them
+        data = np.load(filename, mmap_mode='r')[:, :num_channels]
+        sidecar = filename[:-len('.npy')] + '.json'
+        if os.path.exists(sidecar):
+            # int16 codes written by simple_scan.py, scale back to volts
+            with open(sidecar, 'r') as f:
+                scale = json.load(f)['scale']
+            return data.astype(np.float32) / np.float32(scale)
+        if np.issubdtype(data.dtype, np.integer):
+            print('WARNING: {} has no .json sidecar, showing raw int16 codes instead of volts'.format(filename))
+        return data
+    return get_channel_data(list(range(num_channels)), filename)
+
 #
-#   This method pull n channel data from file and returns list of floats
+#   Loaded file contents are shared between all widgets and ticks. The cache is
+#   keyed on mtime so a rewritten file gets reloaded. Two entries is enough for
+#   the current and previous file. Columns are indexed by channel number.
 #
-def get_single_channel_data(selected_channel, filename):
-    data = []
-    with open(filename, 'r') as f:
-        start = time.time()
-        for i, line in enumerate(f.readlines()):
-            if time.time()-start >= 1:
-                start = time.time()
-            channel_data = line.split(',')
-            data.append(float(channel_data[selected_channel]))
-    return(data)
+def load_data_cached(filename, num_channels):
+    return _load_file(*file_key(filename), num_channels)
+
+def file_key(filename):
+    # identifies a specific version of a data file
+    return (str(filename), os.stat(filename).st_mtime_ns)
 
 
 class SyncedPlots(QtWidgets.QWidget):
     """docstring for SyncedPlots"""
-    def __init__(self, widgets, data_dir, t_series_widget, apptick_hz=1, debug=False):
+    def __init__(self, widgets, data_dir, t_series_widget, debug=False):
         super(SyncedPlots, self).__init__()
         self.widgets = widgets
         self.data_dir = data_dir
         self.t_series_widget = t_series_widget
 
-        self.layout_h = QtWidgets.QHBoxLayout()
-        for widget in self.widgets:
-            self.layout_h.addWidget(widget)
+        # parse each file once and share the columns between all widgets
+        self.num_channels = max(ch for widget in self.widgets + [self.t_series_widget] for ch in widget.channels) + 1
+        self._last_key = None
+        # a full draw has been requested but hasn't happened yet
+        self._busy = False
+        self._pending = False
 
-        self.setLayout(self.layout_h)
+        self._init_figure()
 
-        self.layout_v = QtWidgets.QVBoxLayout()
-        self.layout_v.stretch(1)
-        self.layout_v.addWidget(self.t_series_widget)
+        self.debug = debug
 
-        self.setLayout(self.layout_v)
+        # update when the DAQ adds a file instead of polling the directory, the
+        # watcher silently ignores missing paths so make sure the directory exists
+        os.makedirs(str(self.data_dir), exist_ok=True)
+        self.watcher = QtCore.QFileSystemWatcher([str(self.data_dir)])
+        self.watcher.directoryChanged.connect(self._on_new_file)
+        # show whatever is already in the directory once the event loop starts
+        QtCore.QTimer.singleShot(0, self.update)
+
+    def _init_figure(self):
+        # one figure for every widget so an update is a single layout pass and render
+        self.figure = Figure(constrained_layout=True)
+        self.canvas = FigureCanvas(self.figure)
 
-        self.apptick_hz = apptick_hz
-        self.debug = debug
+        self.layout = QtWidgets.QVBoxLayout()
+        self.layout.setContentsMargins(0, 0, 0, 0)
+        self.layout.addWidget(self.canvas)
+        self.setLayout(self.layout)
 
-        self.timer = QtCore.QTimer()
-        self.apptick_hz = apptick_hz
-        self.timer.setInterval((1 / self.apptick_hz) * 1000)
-        self.timer.timeout.connect(self.update)
-        self.timer.start()
+        # one column per channel widget with the time series widget spanning the bottom
+        self.gs = self.figure.add_gridspec(nrows=2, ncols=len(self.widgets),
+                                           height_ratios=[3, self.t_series_widget.nrows])
+        for col, widget in enumerate(self.widgets):
+            widget.attach(self.figure, self.gs[0, col])
+        self.t_series_widget.attach(self.figure, self.gs[1, :])
+
+        # artists redrawn on every update via blitting (see blit)
+        self.bg = None
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+
+    def _on_draw(self, event):
+        # cache the static parts of the figure (axes, ticks, labels) after every full draw
+        self.bg = self.canvas.copy_from_bbox(self.figure.bbox)
+        self._draw_animated()
+        self._draw_done()
+
+    def _draw_done(self):
+        # release the draw gate, safe to call more than once per draw
+        if not self._busy:
+            return
+        self._busy = False
+        if self._pending:
+            # a file arrived while drawing, pick it up now
+            self._pending = False
+            QtCore.QTimer.singleShot(0, self.update)
+
+    def _draw_animated(self):
+        for widget in self.widgets + [self.t_series_widget]:
+            for artist in widget.animated_artists:
+                artist.axes.draw_artist(artist)
+
+    def blit(self):
+        # redraw only the animated artists on top of the cached background
+        if self.bg is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.bg)
+        self._draw_animated()
+        self.canvas.blit(self.figure.bbox)
+
+    def _on_new_file(self, path):
+        self.update()
 
     def update(self):
+        if self._busy:
+            # don't queue another render behind one Qt hasn't painted yet
+            self._pending = True
+            return
+
         current_file = get_newest_file(self.data_dir)
         if current_file:
-            for widget in self.widgets:
-                widget.update(current_file=current_file)
-            self.t_series_widget.update(current_file=current_file)
+            # nothing to redraw until the DAQ writes a new file, two files can
+            # share a coarse mtime so compare the path and mtime_ns together
+            key = file_key(current_file)
+            if key == self._last_key:
+                return
+            self._last_key = key
+
+            # time the whole load (not individual rows) when debugging parse rate
+            start = time.perf_counter()
+            file_data = load_data_cached(current_file, self.num_channels)
+            if self.debug: print('Loaded {} in {:.3f}s'.format(current_file, time.perf_counter() - start))
+            # widgets only update their artists, the canvas is refreshed once for all of them
+            needs_draw = False
+            for widget in self.widgets + [self.t_series_widget]:
+                needs_draw |= bool(widget.update(data=widget.get_data(file_data), key=key))
+            if needs_draw:
+                self._busy = True
+                try:
+                    self.canvas.draw_idle()
+                finally:
+                    # the Qt backend swallows errors raised by draw() and skips zero-size canvases,
+                    # neither fires a draw_event so also release the gate once the idle draw has run
+                    QtCore.QTimer.singleShot(0, self._draw_done)
+            else:
+                self.blit()
         else:
             if self.debug: print('No files in data directory....')
 
-class RTPlot(QtWidgets.QWidget):
+class RTPlot(object):
     """docstring for RTPlot"""
-    def __init__(self, nrows=1, ncols=1, apptick_hz=1):
-        super().__init__()
-        self.layout = QtWidgets.QVBoxLayout()
-        self.layout.setContentsMargins(0, 0, 0, 0)
-
+    def __init__(self, nrows=1, ncols=1):
+        # axes live in a figure owned by SyncedPlots, they are created by attach()
         self.nrows = nrows
         self.ncols = ncols
-        self._init_plot()
-        self.setLayout(self.layout)
-
-    def _init_plot(self):
-        self.figure = Figure()
-        self.canvas = FigureCanvas(self.figure)
-
-        self.layout.addWidget(self.canvas)
-
-        self.gs = self.figure.add_gridspec(nrows=self.nrows, ncols=self.ncols)
+        self.channels = []
+        self.animated_artists = []
+
+    def attach(self, figure, subplot_spec):
+        self.figure = figure
+        self.canvas = figure.canvas
+        self._init_plot(subplot_spec)
+        self._fitted = False
+        self._init_artists()
+
+    def _init_plot(self, subplot_spec):
+        self.gs = subplot_spec.subgridspec(nrows=self.nrows, ncols=self.ncols)
         self.axes = [[]]
 
         for col in range(self.ncols):
@@ -106,25 +227,41 @@ class RTPlot(QtWidgets.QWidget):
 
         self.ax = self.axes[0][0]
 
+    def _init_artists(self):
+        pass
+
+    def _fit_limits(self, set_lim, get_lim, lo, hi, pad=0.0, log=False):
+        # refit axis limits when the data leaves the current view or fills less than half of it,
+        # returns True if a full draw is needed. spans of log axes are compared in decades
+        cur_lo, cur_hi = get_lim()
+        margin = (hi - lo) * pad or pad
+        new_lo, new_hi = lo - margin, hi + margin
+        span = (lambda a, b: np.log10(b / a)) if log else (lambda a, b: b - a)
+        if (self._fitted and cur_lo <= lo and hi <= cur_hi
+                and span(new_lo, new_hi) >= 0.5 * span(cur_lo, cur_hi)):
+            return False
+        set_lim(new_lo, new_hi)
+        return True
+
     def clear_axes(self):
         for col in range(self.ncols):
             for row in range(self.nrows):
                 self.axes[col][row].clear()
 
-    def get_data(self):
+    def get_data(self, file_data=None):
         return [random.random() for i in range(200)]
 
-    def update_axes(self):
-        data = self.get_data()
-
+    def update_axes(self, data, key=None):
         if data:
             self.ax.clear()
             self.ax.plot(data, '*-')
-            # refresh canvas
-            self.canvas.draw()
+            # axes changed, needs a full draw
+            return True
+        return False
 
     def update(self, *args, **kwargs):
-        self.update_axes(*args, **kwargs)
+        # returns True if the figure needs a full draw instead of a blit
+        return self.update_axes(*args, **kwargs)
 
 
 class MultiChannelVoltageTSeriesPlot(RTPlot):
@@ -133,31 +270,40 @@ class MultiChannelVoltageTSeriesPlot(RTPlot):
         super(MultiChannelVoltageTSeriesPlot, self).__init__(nrows=nrows, ncols=ncols)
         self.channels = channels
         self.num_samples = num_samples
-        self.title = 'Voltage Timeseries for channels: {}'.format(*channels)
-        
+        self.title = 'Voltage Timeseries for channels: {}'.format(', '.join(str(ch) for ch in channels))
+
+    def _init_artists(self):
         # create t_series axis
         self.axMultiTSeries = self.ax
+        self.axMultiTSeries.set_title(self.title)
 
-    def get_data(self, current_file):
-        data = []
-        for i in self.channels:
-            data.append(list(get_single_channel_data(filename=current_file, selected_channel=i)[:self.num_samples]))
-        return data
+        # one line per channel from a single plot call, updated in place
+        self._lines = self.axMultiTSeries.plot(np.zeros((0, len(self.channels))), animated=True)
+        for ch, line in zip(self.channels, self._lines):
+            line.set_label('Channel {}'.format(ch))
+        self.axMultiTSeries.legend(loc='upper right')
 
-    def update_axes(self, current_file):
-        data = self.get_data(current_file)
+        self.animated_artists = list(self._lines)
 
-        if data:
-            # self.clear_axes()
-            self.axMultiTSeries.set_title(self.title)
+    def get_data(self, file_data):
+        # one row per channel, first num_samples samples
+        return file_data[:self.num_samples, self.channels].T
 
-            for ch, t_series in zip(self.channels, data):
-                # print(ch, t_series[:5])
-                # channel, t_series of first n samples (defined by num_samples)
-                self.axMultiTSeries.plot([1.1, 2.2, 3.3])#t_series, label='Channel {}'.format(ch))
-            
-            # refresh canvas
-            self.canvas.draw()
+    def update_axes(self, data, key=None):
+        if data.size:
+            # channel, t_series of first n samples (defined by num_samples)
+            x = np.arange(data.shape[1])
+            for line, t_series in zip(self._lines, data):
+                line.set_data(x, t_series)
+
+            # axis limits are part of the cached background, only redraw everything when they move
+            needs_draw = any([
+                self._fit_limits(self.axMultiTSeries.set_xlim, self.axMultiTSeries.get_xlim, 0, data.shape[1]),
+                self._fit_limits(self.axMultiTSeries.set_ylim, self.axMultiTSeries.get_ylim, float(data.min()), float(data.max()), pad=0.1),
+            ])
+            self._fitted = True
+            return needs_draw
+        return False
 
 
 class SingleChannelPlot(RTPlot):
@@ -165,23 +311,91 @@ class SingleChannelPlot(RTPlot):
     def __init__(self, title='', channel=0, fs=100000, nfft=1024, duration=1):
         super(SingleChannelPlot, self).__init__(nrows=3, ncols=1)
         self.channel = channel
+        self.channels = [channel]
         if title != '':
             self.title = title
         else:
             self.title = 'Channel {}'.format(self.channel)
 
+        self._last_key = None
         self.fs = fs
         self.nfft = nfft
+        self._init_fft()
         self.duration = duration
         self.cmap = 'viridis'
+        self._init_cmap()
         self.waterfall_data = deque(maxlen=int(fs + fs / 2))
 
+        # self._init_param_editor()
+
+    def _init_artists(self):
         # create attrs for each axes
         self.axSpec = self.axes[0][0]
         self.axPSD = self.axes[0][1]
         self.axVT = self.axes[0][2]
 
-        # self._init_param_editor()
+        self.ax.set_title(self.title)
+
+        # spectrogram is colored by _colorize, the image only holds RGBA pixels
+        self._im = self.axSpec.imshow(np.zeros((self.nfft // 2 + 1, 1, 4), dtype=np.uint8), aspect='auto', origin='lower',
+                                      interpolation='nearest', extent=(0, self.duration, 0, self.fs / 2), animated=True)
+        self.axSpec.set_ylabel('Frequency')
+
+        self._psd_line, = self.axPSD.plot([], [], animated=True)
+        self.axPSD.set_xlim(0, self.fs / 2)
+        # log scale needs positive limits before any data arrives
+        self.axPSD.set_ylim(1e-12, 1)
+        self.axPSD.set_yscale('log')
+        self.axPSD.set_xlabel('Frequency')
+        self.axPSD.set_ylabel('Power Spectral Density (V**2/Hz)')
+        self.axPSD.grid(True)
+
+        self._vt_line, = self.axVT.plot([], [], animated=True)
+
+        self.animated_artists = [self._im, self._psd_line, self._vt_line]
+
+    def _init_cmap(self):
+        # 256 entry RGBA lookup table, indexing it replaces per-update colormap normalization
+        self._cmap_lut = (plt.get_cmap(self.cmap)(np.linspace(0, 1, 256)) * 255).astype(np.uint8)
+
+    def _colorize(self, Sxx_db):
+        # scale to the finite range of this update (like autoscale) and map through the LUT
+        finite = Sxx_db[np.isfinite(Sxx_db)]
+        if not finite.size:
+            return self._cmap_lut[np.zeros(Sxx_db.shape, dtype=np.uint8)]
+        vmin, vmax = finite.min(), finite.max()
+        norm = np.clip((Sxx_db - vmin) * (255 / ((vmax - vmin) or 1.0)), 0, 255)
+        return self._cmap_lut[np.nan_to_num(norm).astype(np.uint8)]
+
+    def _init_fft(self):
+        # window, PSD normalization and frequency bins only change with fs/nfft, compute them once
+        self._win = scipy.signal.get_window('hann', self.nfft).astype(np.float32)
+        self._scale = 1.0 / (self.fs * (self._win ** 2).sum())
+        # 128 samples as before for the default nfft, scipy's nperseg // 8 for small nfft so the hop stays positive
+        self.noverlap = min(128, self.nfft // 8)
+        self._hop = self.nfft - self.noverlap
+        self._freqs = scipy.fft.rfftfreq(self.nfft, 1 / self.fs)
+
+    def _spectrogram(self, data):
+        # one-sided PSD spectrogram, same result as scipy.signal.spectrogram(mode='psd') with the cached window
+        frames = np.lib.stride_tricks.sliding_window_view(data, self.nfft)[::self._hop]
+        frames = frames - frames.mean(axis=1, keepdims=True)
+        spec = scipy.fft.rfft(frames * self._win, axis=-1, workers=-1)
+        Pxx = (spec.real ** 2 + spec.imag ** 2) * self._scale
+        # fold in the negative frequencies, DC (and Nyquist for even nfft) have no mirror
+        Pxx[:, 1:None if self.nfft % 2 else -1] *= 2
+        return self._freqs, Pxx.T
+
+    def _bin_to_pixels(self, Pxx):
+        # average spectrogram columns down to the on-screen width of the axes, extra columns are never visible
+        width = max(int(self.axSpec.bbox.width), 1)
+        if Pxx.shape[1] <= width:
+            return Pxx
+        cols_per_pixel = -(-Pxx.shape[1] // width)
+        num_bins = -(-Pxx.shape[1] // cols_per_pixel)
+        # pad the last bin by repeating the final column
+        Pxx = np.pad(Pxx, ((0, 0), (0, num_bins * cols_per_pixel - Pxx.shape[1])), mode='edge')
+        return Pxx.reshape(Pxx.shape[0], num_bins, cols_per_pixel).mean(axis=2)
 
     def _init_param_editor(self):
         self.params_editor_layout = QtWidgets.QFormLayout()
@@ -212,28 +426,50 @@ class SingleChannelPlot(RTPlot):
             self.title = params['title']
             self.sample_rate = params['sample_rate']
             self.nfft = params['NFFT']
+            self._init_fft()
             self.cmap = params['cmap']
+            self._init_cmap()
     
-    def get_data(self, current_file):
+    def get_data(self, file_data):
         # returns 1D vector of the voltage timeseries for a specific channel
-        return get_single_channel_data(filename=current_file, selected_channel=self.channel)
+        return file_data[:, self.channel]
 
-    def update_axes(self, current_file):
-        data = self.get_data(current_file)
+    def update_axes(self, data, key=None):
+        if key is not None and key == self._last_key:
+            # already showing this file, skip the FFT and redraw
+            return False
 
-        if data:
+        if data.size >= self.nfft:
+            self._last_key = key
             self.waterfall_data.append(data)
             # data = self.waterfall_data
 
-            self.clear_axes()
-            self.ax.set_title(self.title)
-
-            Pxx, freqs, bins, im = self.axSpec.specgram(data, NFFT=self.nfft, Fs=self.fs, cmap=self.cmap, scale='dB')
-            # self.axPSD.imshow(freqs)
-            self.axPSD.psd(Pxx, self.nfft, self.fs)
-            self.axVT.plot(data)
-            # refresh canvas
-            self.canvas.draw()
+            freqs, Pxx = self._spectrogram(data)
+            # a flat channel has zero power, _colorize handles the resulting -inf
+            with np.errstate(divide='ignore'):
+                Sxx_db = 10 * np.log10(self._bin_to_pixels(Pxx))
+            self._im.set_data(self._colorize(Sxx_db))
+
+            # PSD is the spectrogram averaged over time, no second FFT pass
+            psd_vals = Pxx.mean(axis=1)
+            self._psd_line.set_data(freqs, psd_vals)
+
+            self._vt_line.set_data(np.arange(len(data)), data)
+
+            # axis limits are part of the cached background, only redraw everything when they move
+            positive_psd = psd_vals[psd_vals > 0]
+            needs_draw = any([
+                self._fit_limits(self.axSpec.set_xlim, self.axSpec.get_xlim, 0, len(data) / self.fs),
+                # a flat channel has no positive PSD values, keep the current (positive) limits
+                self._fit_limits(self.axPSD.set_ylim, self.axPSD.get_ylim, positive_psd.min() / 2, positive_psd.max() * 2, log=True) if positive_psd.size else False,
+                self._fit_limits(self.axVT.set_xlim, self.axVT.get_xlim, 0, len(data)),
+                self._fit_limits(self.axVT.set_ylim, self.axVT.get_ylim, float(data.min()), float(data.max()), pad=0.1),
+            ])
+            self._fitted = True
+            if needs_draw:
+                self._im.set_extent((0, len(data) / self.fs, 0, self.fs / 2))
+            return needs_draw
+        return False
 
 
 def main(app):
@@ -243,8 +479,7 @@ def main(app):
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="AQUABAT RT Display")
-    parser.add_argument('-t', '--apptick', help='Apptick/Display update rate in Hz', required=False, type=float, default=10)
-    parser.add_argument('--data-directory', help='Directory where csv data from DAQ buffer is stored', default='./', required=False)
+    parser.add_argument('--data-directory', help='Directory where data files from DAQ buffer are stored', default='./', required=False)
     parser.add_argument('-c', '--channels', help='Number of channels to display', default=2, required=False, type=int)
     parser.add_argument('--t-series-samples', help='Number of values to overlap in voltage time series (first N samples)', default=1000, required=False, type=int)
     parser.add_argument('--fs', '--sample-rate', help='Sample rate in Hz', default=100000, required=False, type=int)
@@ -37,19 +37,53 @@ import sys
 from uldaq import (get_daq_device_inventory, DaqDevice, AInScanFlag, ScanStatus,
                    ScanOption, create_float_buffer, InterfaceType, AiInputMode)
 import threading
+import functools
+import json
 import pathlib
-import csv
+import queue
 import time
-from copy import deepcopy
+import numpy as np
 
-def dump_csv_data(data, filename, made_copy):
-    clone = deepcopy(data)
-    made_copy.set() # now we can clear contents in main thread
+# status display refresh period in seconds, printing on every poll stalls the acquisition loop
+PRINT_INTERVAL = 0.1
+# terminal escape that clears the current line
+CLEAR_EOL = '\x1b[2K'
+
+def dump_data(data, filename, scale, fs):
     # data is a 2D array of channel data
     # columns represent channels 0 through, N-1.
-    with open(str(filename), 'w+') as f:
-        csv_writer = csv.writer(f, delimiter=',')
-        csv_writer.writerows(clone)
+    # stored as raw int16 ADC-style codes (volts * scale) in a binary .npy,
+    # the .json sidecar holds what the display needs to convert back to volts
+    filename = pathlib.Path(filename)
+    with open(str(filename.with_suffix('.json')), 'w') as f:
+        json.dump({'scale': scale, 'fs': fs}, f)
+    codes = np.clip(np.rint(data * scale), -32768, 32767).astype(np.int16)
+    np.save(str(filename), codes)
+
+def file_writer(write_queue, write_file, latest):
+    """Write (data, filename, done) items from write_queue until None is queued.
+
+    A failed write is stored in latest['write_error'] for the drain loop to report and the writer stops.
+    """
+    while True:
+        item = write_queue.get()
+        if item is None:
+            return
+        data, filename, done = item
+        try:
+            write_file(data=data, filename=filename)
+        except Exception as error:
+            latest['write_error'] = 'Error: failed to write {}: {}'.format(filename, error)
+            return
+        finally:
+            # never leave the drain loop waiting on this half
+            done.set()
+
+def status_printer(show_status, latest, stop):
+    """Refresh the status display every PRINT_INTERVAL seconds until stop is set."""
+    while not stop.wait(PRINT_INTERVAL):
+        if latest['transfer_status'] is not None:
+            show_status(latest['transfer_status'], latest['dropped_scans'])
 
 def main(args):
     """Analog input scan example."""
@@ -131,8 +165,14 @@ def main(args):
         if range_index >= len(ranges):
             range_index = len(ranges) - 1
 
+        # int16 full scale maps to the selected input range, checked before the scan starts
+        scale = 32767 / range_max_volts(ranges[range_index])
+
         # Allocate a buffer to receive the data.
         data = create_float_buffer(channel_count, samples_per_channel)
+        # zero-copy numpy view of the scan buffer, scan_rows has one row per scan
+        scan_data = np.ctypeslib.as_array(data)
+        scan_rows = scan_data.reshape(samples_per_channel, channel_count)
 
         print('\n', descriptor.dev_string, ' ready', sep='')
         print('    Function demonstrated: ai_device.a_in_scan()')
@@ -155,64 +195,101 @@ def main(args):
                                    rate, scan_options, flags, data)
 
         aq_start_time = time.time()
-        file_buffer = []
+        write_file = functools.partial(dump_data, scale=scale, fs=rate)
+        # ring buffer holding two files worth of scans (one row per scan, columns are channels)
+        # one half is filled while the other half is written to file
+        ring = np.empty((2 * samples_per_channel, channel_count), dtype=np.float64)
+        half_free = [threading.Event(), threading.Event()]
+        for event in half_free:
+            event.set()
+        head = 0
+        # total number of scans copied out of the (circular) scan buffer so far
+        scans_read = 0
+
+        # file writing and the status display run in their own threads so the drain loop never blocks on IO
+        show_status = functools.partial(print_status, descriptor, rate, low_channel, scan_data, channel_count)
+        latest = {'transfer_status': None, 'dropped_scans': 0, 'write_error': None}
+        stop = threading.Event()
+        write_queue = queue.Queue()
+        threads = []
+        if not args.single_threaded:
+            threads.append(threading.Thread(target=file_writer, args=(write_queue, write_file, latest), daemon=True))
+            threads.append(threading.Thread(target=status_printer, args=(show_status, latest, stop), daemon=True))
+            for thread in threads:
+                thread.start()
+        last_print = 0.0
         try:
             while True:
                 try:
+                    if latest['write_error']:
+                        # the writer thread stopped, don't keep scanning without saving
+                        raise RuntimeError(latest['write_error'])
+
                     # Get the status of the background operation
                     status, transfer_status = ai_device.get_scan_status()
-
-                    reset_cursor()
-                    print('Please enter CTRL + C to terminate the process\n')
-                    print('Active DAQ device: ', descriptor.dev_string, ' (',
-                          descriptor.unique_id, ')\n', sep='')
-
-                    print('actual scan rate = ', '{:.6f}'.format(rate), 'Hz\n')
-
-                    index = transfer_status.current_index
-                    print('currentTotalCount = ',
-                          transfer_status.current_total_count)
-                    print('currentScanCount = ',
-                          transfer_status.current_scan_count)
-                    print('currentIndex = ', index, '\n')
-
-                    # Display the data.
-                    current_samples = []
-                    for i in range(channel_count):
-                        clear_eol()
-                        print('chan =',
-                              i + low_channel, ': ',
-                              '{:.6f}'.format(data[index + i]))
-                        current_samples.append(data[index + i])
-
-                    file_buffer.append(current_samples)
-                    # do we have enough rows to dump to file?
-                    if len(file_buffer) >= args.sample_rate * args.file_duration:
-                        filename = args.data_directory.joinpath('{}.txt'.format(aq_start_time))
-                        # update aq_start_time
-                        aq_start_time += float(args.file_duration)
-
-                        made_copy = threading.Event()
-                        if args.single_threaded:
-                            threading.Thread(target=dump_csv_data, 
-                                             kwargs={
-                                                'data': file_buffer,
-                                                'filename': filename,
-                                                'made_copy': made_copy,
-                                                }).start()
-                            made_copy.wait()
-                        else:
-                            dump_csv_data(data=file_buffer,
-                                          filename=filename,
-                                          made_copy=made_copy)
-                        # now we can clear file_buffer
-                        file_buffer = []
+                    latest['transfer_status'] = transfer_status
+
+                    if args.single_threaded:
+                        now = time.monotonic()
+                        if now - last_print >= PRINT_INTERVAL:
+                            last_print = now
+                            show_status(transfer_status, latest['dropped_scans'])
+
+                    if transfer_status.current_index < 0:
+                        # no samples transferred yet
+                        continue
+
+                    scan_count = transfer_status.current_scan_count
+                    if scan_count - scans_read > samples_per_channel:
+                        # scan buffer wrapped around before we got to it, skip ahead
+                        # the count is shown by the status display, a print here would be drawn over
+                        latest['dropped_scans'] += scan_count - scans_read - samples_per_channel
+                        scans_read = scan_count - samples_per_channel
+
+                    # copy every scan since the last poll into the ring in contiguous blocks
+                    while scans_read < scan_count:
+                        half = head // samples_per_channel
+                        half_end = (half + 1) * samples_per_channel
+                        if head % samples_per_channel == 0:
+                            # starting to fill this half again, its last file has to be on disk first
+                            half_free[half].wait()
+                            if latest['write_error']:
+                                raise RuntimeError(latest['write_error'])
+
+                        start = scans_read % samples_per_channel
+                        num_rows = min(scan_count - scans_read,
+                                       samples_per_channel - start,
+                                       half_end - head)
+                        ring[head:head + num_rows] = scan_rows[start:start + num_rows]
+                        head += num_rows
+                        scans_read += num_rows
+
+                        # do we have enough rows to dump to file?
+                        if head == half_end:
+                            filename = args.data_directory.joinpath('{}.npy'.format(aq_start_time))
+                            # update aq_start_time
+                            aq_start_time += float(args.file_duration)
+
+                            file_data = ring[half_end - samples_per_channel:half_end]
+                            if args.single_threaded:
+                                write_file(data=file_data,
+                                           filename=filename)
+                            else:
+                                half_free[half].clear()
+                                write_queue.put((file_data, filename, half_free[half]))
+                            head %= len(ring)
 
                     # sleep(0.1)
                 except (ValueError, NameError, SyntaxError):
                     break
         except KeyboardInterrupt:
             pass
+        finally:
+            # let the writer finish any queued files before exiting
+            stop.set()
+            write_queue.put(None)
+            for thread in threads:
+                thread.join()
 
     except RuntimeError as error:
         print('\n', error)
@@ -238,22 +315,49 @@ def display_scan_options(bit_mask):
     return ', '.join(options)
 
 
+def range_max_volts(ai_range):
+    """Return the full scale voltage of a range, e.g. BIP10VOLTS -> 10.0, BIPPT625VOLTS -> 0.625."""
+    name = ai_range.name
+    if name[:3] not in ('BIP', 'UNI') or not name.endswith('VOLTS'):
+        raise RuntimeError('Error: Unsupported input range ' + name)
+    return float(name[3:-len('VOLTS')].replace('PT', '.'))
+
+
+def print_status(descriptor, rate, low_channel, scan_data, channel_count, transfer_status, dropped_scans):
+    """Redraw the status display with the most recent scan."""
+    index = transfer_status.current_index
+    samples = scan_data[index:index + channel_count] if index >= 0 else []
+    reset_cursor()
+    stdout.write(format_status(descriptor, rate, transfer_status, low_channel, samples, dropped_scans))
+    stdout.flush()
+
+
+def format_status(descriptor, rate, transfer_status, low_channel, samples, dropped_scans=0):
+    """Build the status display as a single string so it is written in one go."""
+    lines = [
+        'Please enter CTRL + C to terminate the process\n',
+        f'Active DAQ device: {descriptor.dev_string} ({descriptor.unique_id})\n',
+        f'actual scan rate =  {rate:.6f} Hz\n',
+        f'currentTotalCount =  {transfer_status.current_total_count}',
+        f'currentScanCount =  {transfer_status.current_scan_count}',
+        f'currentIndex =  {transfer_status.current_index}',
+        f'droppedScans =  {dropped_scans} \n',
+    ]
+    lines += [f'{CLEAR_EOL}chan = {i + low_channel} :  {value:.6f}' for i, value in enumerate(samples)]
+    return '\n'.join(lines) + '\n'
+
+
 def reset_cursor():
     """Reset the cursor in the terminal window."""
     stdout.write('\033[1;1H')
 
 
-def clear_eol():
-    """Clear all characters to the end of the line."""
-    stdout.write('\x1b[2K')
-
-
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="AQUABAT RT Display")
     parser.add_argument('-fs', '--sample-rate', help='Sample rate in Hz', required=False, type=int, default=1000)
     parser.add_argument('--file-duration', help='File duration seconds', required=False, type=int, default=1)
-    parser.add_argument('--data-directory', help='Directory where csv data will be stored', default='./', required=False)
+    parser.add_argument('--data-directory', help='Directory where data files will be stored', default='./', required=False)
     parser.add_argument('-c', '--channels', help='Number of channels to display', default=2, required=False, type=int)
     parser.add_argument('-s', '--single-threaded', action="store_true", help="Run single threaded (useful for machines with less cores)")
     parser.add_argument('-d', '--debug', action="store_true", help="Print debug messages")